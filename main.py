@@ -10,9 +10,11 @@ from slowapi import _rate_limit_exceeded_handler
 from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
 from deps import limiter, get_db
+from profiling import ProfilingMiddleware, install_slow_query_log
 
 load_dotenv()
 Base.metadata.create_all(bind=engine)
+install_slow_query_log(engine)
 app = FastAPI(
     title="Books API",
     description="RESTful API for book management with user authentication, featuring CRUD operations and real-time updates",
@@ -27,10 +29,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id", "X-Profile-Skipped"],
 )
 app.add_middleware(
     SessionMiddleware, secret_key=os.getenv("SECRET_KEY"), https_only=True
 )
+# Opt-in request profiling and route tagging for the slow query log
+app.add_middleware(ProfilingMiddleware)
 api_version = os.getenv("API_VERSION")
 # Rate limiting for all routes to prevent abuse
 app.state.limiter = limiter
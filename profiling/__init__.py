@@ -0,0 +1,3 @@
+from .middleware import ProfilingMiddleware
+from .sampler import StackSampler
+from .slow_query import install_slow_query_log
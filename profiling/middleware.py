@@ -0,0 +1,191 @@
+import glob
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+import anyio.to_thread
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from .sampler import StackSampler
+from .slow_query import current_scope, route_label
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger("books.profiling")
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
+# Streaming routes never finish on their own, so they are left out of random sampling
+PROFILE_EXCLUDE_PATHS = [
+    path for path in os.getenv("PROFILE_EXCLUDE_PATHS", "/updates").split(",") if path
+]
+
+# Only one request is profiled at a time to keep the overhead bounded. The
+# sampler thread releases it once the profile is written.
+_profiler_lock = threading.Lock()
+
+# Sampler of the request being profiled, copied into threadpool calls
+_current_sampler: ContextVar[Optional[StackSampler]] = ContextVar(
+    "current_sampler", default=None
+)
+
+_run_sync = anyio.to_thread.run_sync
+
+
+async def _run_sync_profiled(func, *args, **kwargs):
+    """Register the worker thread with the request's sampler while it runs.
+
+    FastAPI and Starlette run sync endpoints and dependencies through
+    `anyio.to_thread.run_sync`, so this is where a request hands work to the
+    threadpool.
+    """
+    sampler = _current_sampler.get()
+    if sampler is None:
+        return await _run_sync(func, *args, **kwargs)
+
+    def profiled(*args):
+        thread_id = threading.get_ident()
+        sampler.add_thread(thread_id, sys._getframe())
+        try:
+            return func(*args)
+        finally:
+            sampler.remove_thread(thread_id)
+
+    return await _run_sync(profiled, *args, **kwargs)
+
+
+def write_profile(directory: str, profile_id: str, folded: str):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{profile_id}.folded"), "w") as f:
+        f.write(folded)
+
+
+def prune_profiles(directory: str, max_files: int):
+    """Remove the oldest profiles beyond `max_files`."""
+    profiles = []
+    for path in glob.glob(os.path.join(directory, "*.folded")):
+        try:
+            profiles.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    profiles.sort()
+    for _, path in profiles[: max(len(profiles) - max_files, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _finish_profile(sampler: StackSampler, profile_id: str, scope: Scope):
+    """Write the profile and release the profiler, on the sampler thread."""
+    try:
+        try:
+            write_profile(PROFILE_DIR, profile_id, sampler.folded())
+        except OSError as e:
+            logger.error("failed to write profile id=%s: %s", profile_id, e)
+            return
+        logger.info(
+            "profiled route=%s id=%s %s", route_label(scope), profile_id, sampler.summary()
+        )
+        try:
+            prune_profiles(PROFILE_DIR, PROFILE_MAX_FILES)
+        except OSError as e:
+            logger.warning("failed to prune profiles in %s: %s", PROFILE_DIR, e)
+    finally:
+        _profiler_lock.release()
+
+
+def _with_headers(send: Send, headers: dict) -> Send:
+    async def send_wrapper(message: Message):
+        if message["type"] == "http.response.start":
+            response_headers = MutableHeaders(scope=message)
+            for key, value in headers.items():
+                response_headers.append(key, value)
+        await send(message)
+
+    return send_wrapper
+
+
+class ProfilingMiddleware:
+    """Tags queries with their route and optionally profiles the request.
+
+    A request is profiled when it carries an `X-Profile-Token` header matching
+    the PROFILE_TOKEN env var, or when it is picked by PROFILE_SAMPLE_RATE and
+    its path does not end with one of PROFILE_EXCLUDE_PATHS.
+
+    The event loop thread is sampled while it runs this request's task, along
+    with any threadpool workers running the request's sync dependencies, so
+    concurrent requests stay out of the profile. Profiling stops when the
+    request ends or after PROFILE_MAX_SECONDS. The folded stacks are written
+    to PROFILE_DIR and the file name is returned in the `X-Profile-Id`
+    response header.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        anyio.to_thread.run_sync = _run_sync_profiled
+
+    def _has_profile_token(self, request: Request) -> bool:
+        token = request.headers.get("X-Profile-Token")
+        return bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+
+    def _should_profile(self, request: Request) -> bool:
+        if self._has_profile_token(request):
+            return True
+        if any(request.scope["path"].endswith(path) for path in PROFILE_EXCLUDE_PATHS):
+            return False
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        scope_token = current_scope.set(scope)
+        try:
+            await self._dispatch(scope, receive, send)
+        finally:
+            current_scope.reset(scope_token)
+
+    async def _dispatch(self, scope: Scope, receive: Receive, send: Send):
+        request = Request(scope)
+        if not self._should_profile(request):
+            await self.app(scope, receive, send)
+            return
+        if not _profiler_lock.acquire(blocking=False):
+            if self._has_profile_token(request):
+                logger.info("profiler busy, skipped path=%s", request.scope["path"])
+                send = _with_headers(send, {"X-Profile-Skipped": "busy"})
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+        sampler = StackSampler(
+            threading.get_ident(),
+            root_frame=sys._getframe(),
+            interval=PROFILE_INTERVAL_MS / 1000,
+            max_duration=PROFILE_MAX_SECONDS,
+            on_finish=lambda sampler: _finish_profile(sampler, profile_id, scope),
+        )
+        sampler.start()
+        sampler_token = _current_sampler.set(sampler)
+        try:
+            await self.app(
+                scope, receive, _with_headers(send, {"X-Profile-Id": profile_id})
+            )
+        finally:
+            _current_sampler.reset(sampler_token)
+            sampler.stop()
+            await run_in_threadpool(sampler.join)
@@ -0,0 +1,127 @@
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+AWAITING = "(awaiting)"
+THREADPOOL = "(threadpool)"
+
+
+class StackSampler:
+    """Low overhead stack-sampling profiler for a single request.
+
+    A background thread snapshots the stacks of the request's threads at a
+    fixed interval and counts the samples in the folded format understood by
+    flamegraph.pl and speedscope (`frame;frame;frame count`).
+
+    The loop thread is only sampled while its stack passes through
+    `root_frame`, which narrows the shared event loop down to one task. Worker
+    threads register themselves with `add_thread` while they run sync code for
+    the request and are folded under a `(threadpool)` frame. Ticks where
+    neither is running are counted as `(awaiting)` so the wall time adds up.
+
+    Sampling stops on `stop()` or after `max_duration` seconds, whichever
+    comes first, and `on_finish` is then called on the sampler thread.
+    """
+
+    def __init__(
+        self,
+        thread_id: int,
+        root_frame,
+        interval: float = 0.005,
+        max_duration: Optional[float] = None,
+        on_finish: Optional[Callable[["StackSampler"], None]] = None,
+    ):
+        self.thread_id = thread_id
+        self.root_frame = root_frame
+        self.interval = interval
+        self.max_duration = max_duration
+        self.on_finish = on_finish
+        self.stacks: Counter = Counter()
+        self._workers: Dict[int, object] = {}
+        self._workers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Ask the sampler to stop, without waiting for it."""
+        self._stop.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def add_thread(self, thread_id: int, root_frame):
+        with self._workers_lock:
+            self._workers[thread_id] = root_frame
+
+    def remove_thread(self, thread_id: int):
+        with self._workers_lock:
+            self._workers.pop(thread_id, None)
+
+    def _run(self):
+        deadline = None
+        if self.max_duration is not None:
+            deadline = time.monotonic() + self.max_duration
+        try:
+            while not self._stop.wait(self.interval):
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                self._sample()
+        finally:
+            if self.on_finish is not None:
+                self.on_finish(self)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        root = self._label(self.root_frame)
+        sampled = False
+
+        loop_stack = self._fold(frames.get(self.thread_id), self.root_frame)
+        if loop_stack is not None:
+            self.stacks[loop_stack] += 1
+            sampled = True
+
+        with self._workers_lock:
+            workers = list(self._workers.items())
+        for thread_id, worker_root in workers:
+            stack = self._fold(frames.get(thread_id), worker_root)
+            if stack is not None:
+                self.stacks[f"{root};{THREADPOOL};{stack}"] += 1
+                sampled = True
+
+        if not sampled:
+            self.stacks[f"{root};{AWAITING}"] += 1
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+    @classmethod
+    def _fold(cls, frame, root_frame=None):
+        """Fold a stack into `outer;...;inner`, or None if it misses `root_frame`."""
+        if frame is None:
+            return None
+        frames = []
+        while frame is not None:
+            frames.append(cls._label(frame))
+            if frame is root_frame:
+                break
+            frame = frame.f_back
+        else:
+            if root_frame is not None:
+                return None
+        return ";".join(reversed(frames))
+
+    def folded(self) -> str:
+        """Return the collected samples as folded stacks, one per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+    def summary(self) -> Dict[str, int]:
+        return {"samples": sum(self.stacks.values()), "stacks": len(self.stacks)}
@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger("books.slow_query")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+# ASGI scope of the current request, set by the profiling middleware. Routing
+# fills in scope["route"] later, so the route is resolved when a query is logged.
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+
+def route_label(scope: Optional[dict]) -> str:
+    """Return `METHOD /route/{template}`, falling back to the raw path."""
+    if scope is None:
+        return "-"
+    route = scope.get("route")
+    path = getattr(route, "path", None) or scope.get("path", "-")
+    return f"{scope.get('method', '-')} {path}"
+
+
+def parameters_shape(parameters) -> str:
+    """Describe query parameters by type only, so no user data ends up in logs."""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(
+            f"{key}: {type(value).__name__}" for key, value in parameters.items()
+        ) + "}"
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            return f"{len(parameters)} x {parameters_shape(parameters[0])}"
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the per-execution context: a failed statement never reaches the
+    # after hook, and the connection is shared for the life of the process.
+    if context is not None:
+        context._query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start_time", None)
+    if start is None:
+        return
+    duration_ms = (time.perf_counter() - start) * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+    logger.warning(
+        "slow query route=%s duration_ms=%.2f params=%s statement=%s",
+        route_label(current_scope.get()),
+        duration_ms,
+        parameters_shape(parameters),
+        " ".join(statement.split()),
+    )
+
+
+def install_slow_query_log(engine: Engine):
+    """Register the cursor execute hooks that feed the slow query log."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+from profiling import ProfilingMiddleware, StackSampler, install_slow_query_log
+from profiling import middleware, slow_query
+from profiling.slow_query import parameters_shape
+from starlette.requests import Request
+
+
+def test_parameters_shape_dict():
+    assert parameters_shape({"email": "a@b.c", "id": 1}) == "{email: str, id: int}"
+
+
+def test_parameters_shape_tuple():
+    assert parameters_shape(("a@b.c", 1, None)) == "(str, int, NoneType)"
+
+
+def test_parameters_shape_executemany():
+    assert parameters_shape([("a", 1), ("b", 2), ("c", 3)]) == "3 x (str, int)"
+    assert parameters_shape([{"id": 1}, {"id": 2}]) == "2 x {id: int}"
+
+
+def test_folded_line_format():
+    sampler = StackSampler(0, None)
+    sampler.stacks["outer;inner"] += 3
+    sampler.stacks["outer"] += 1
+    assert sampler.folded() == "outer;inner 3\nouter 1\n"
+    assert sampler.summary() == {"samples": 4, "stacks": 2}
+
+
+def test_fold_starts_at_root_frame():
+    def inner():
+        return StackSampler._fold(sys._getframe(), root_frame)
+
+    root_frame = sys._getframe()
+    frames = inner().split(";")
+    assert len(frames) == 2
+    assert frames[0].startswith("test_fold_starts_at_root_frame (")
+    assert frames[1].startswith("inner (")
+
+
+def test_fold_drops_stack_outside_root_frame():
+    def elsewhere():
+        return sys._getframe()
+
+    assert StackSampler._fold(sys._getframe(), elsewhere()) is None
+
+
+def _request(headers, path="/v1/books/get_books"):
+    return Request(
+        {
+            "type": "http",
+            "path": path,
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        }
+    )
+
+
+def test_should_profile_token_match(monkeypatch):
+    monkeypatch.setattr(middleware, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(middleware, "PROFILE_SAMPLE_RATE", 0)
+    profiler = ProfilingMiddleware(None)
+    assert profiler._should_profile(_request({"X-Profile-Token": "secret"}))
+    assert not profiler._should_profile(_request({"X-Profile-Token": "wrong"}))
+    assert not profiler._should_profile(_request({}))
+
+
+def test_should_profile_skips_excluded_paths_unless_token(monkeypatch):
+    monkeypatch.setattr(middleware, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(middleware, "PROFILE_SAMPLE_RATE", 1)
+    monkeypatch.setattr(middleware, "PROFILE_EXCLUDE_PATHS", ["/updates"])
+    profiler = ProfilingMiddleware(None)
+    assert not profiler._should_profile(_request({}, path="/v1/books/updates"))
+    assert profiler._should_profile(
+        _request({"X-Profile-Token": "secret"}, path="/v1/books/updates")
+    )
+
+
+def test_should_profile_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(middleware, "PROFILE_TOKEN", None)
+    monkeypatch.setattr(middleware, "PROFILE_SAMPLE_RATE", 0)
+    profiler = ProfilingMiddleware(None)
+    assert not profiler._should_profile(_request({"X-Profile-Token": ""}))
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    install_slow_query_log(engine)
+    return engine
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, engine):
+    monkeypatch.setattr(middleware, "PROFILE_TOKEN", "secret")
+    monkeypatch.setattr(middleware, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(middleware, "PROFILE_INTERVAL_MS", 1)
+    monkeypatch.setattr(middleware, "PROFILE_MAX_SECONDS", 30)
+    monkeypatch.setattr(middleware, "PROFILE_DIR", str(tmp_path))
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        time.sleep(0.02)
+        with engine.connect() as conn:
+            conn.execute(text("SELECT :id"), {"id": item_id})
+        return {"id": item_id}
+
+    def slow_dependency():
+        time.sleep(0.05)
+
+    @app.get("/with_dependency", dependencies=[Depends(slow_dependency)])
+    async def with_dependency():
+        return {}
+
+    @app.get("/waits")
+    async def waits():
+        await asyncio.sleep(0.05)
+        return {"profiler_locked": middleware._profiler_lock.locked()}
+
+    @app.get("/fails")
+    async def fails():
+        time.sleep(0.02)
+        raise RuntimeError("boom")
+
+    return TestClient(app, raise_server_exceptions=False)
+
+
+def test_profile_file_written(client, tmp_path):
+    response = client.get("/items/1", headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    folded = (tmp_path / f"{profile_id}.folded").read_text()
+    assert "get_item" in folded
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded.splitlines())
+
+
+def test_no_profile_without_token(client, tmp_path):
+    response = client.get("/items/1", headers={"X-Profile-Token": "wrong"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert os.listdir(tmp_path) == []
+
+
+def test_profile_skipped_when_busy(client):
+    with middleware._profiler_lock:
+        response = client.get("/items/1", headers={"X-Profile-Token": "secret"})
+    assert response.headers["X-Profile-Skipped"] == "busy"
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_sync_dependency_in_profile(client, tmp_path):
+    response = client.get("/with_dependency", headers={"X-Profile-Token": "secret"})
+    folded = (tmp_path / f"{response.headers['X-Profile-Id']}.folded").read_text()
+    assert ";(threadpool);" in folded
+    assert "slow_dependency" in folded
+
+
+def test_awaiting_time_in_profile(client, tmp_path):
+    response = client.get("/waits", headers={"X-Profile-Token": "secret"})
+    folded = (tmp_path / f"{response.headers['X-Profile-Id']}.folded").read_text()
+    assert ";(awaiting) " in folded
+
+
+def test_profile_stops_after_max_duration(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(middleware, "PROFILE_MAX_SECONDS", 0.01)
+    response = client.get("/waits", headers={"X-Profile-Token": "secret"})
+    assert response.json() == {"profiler_locked": False}
+    assert (tmp_path / f"{response.headers['X-Profile-Id']}.folded").exists()
+
+
+def test_profile_written_when_request_fails(client, tmp_path):
+    response = client.get("/fails", headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 500
+    [profile] = os.listdir(tmp_path)
+    assert "fails" in (tmp_path / profile).read_text()
+    assert not middleware._profiler_lock.locked()
+
+
+def test_profile_write_failure_does_not_fail_request(
+    client, monkeypatch, tmp_path, caplog
+):
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    monkeypatch.setattr(middleware, "PROFILE_DIR", str(blocker / "profiles"))
+    with caplog.at_level(logging.ERROR, logger="books.profiling"):
+        response = client.get("/items/1", headers={"X-Profile-Token": "secret"})
+    assert response.status_code == 200
+    assert f"failed to write profile id={response.headers['X-Profile-Id']}" in caplog.text
+    assert not middleware._profiler_lock.locked()
+
+
+def test_prune_profiles_keeps_newest(tmp_path):
+    for i in range(3):
+        middleware.write_profile(str(tmp_path), f"p{i}", "a 1\n")
+        os.utime(tmp_path / f"p{i}.folded", (i, i))
+    middleware.prune_profiles(str(tmp_path), max_files=2)
+    assert sorted(os.listdir(tmp_path)) == ["p1.folded", "p2.folded"]
+
+
+def test_slow_query_logged_with_route_template(client, monkeypatch, caplog):
+    monkeypatch.setattr(slow_query, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="books.slow_query"):
+        client.get("/items/42")
+    assert "route=GET /items/{item_id}" in caplog.text
+    assert "params=(int)" in caplog.text
+    assert "42" not in caplog.text
+
+
+def test_fast_query_not_logged(engine, monkeypatch, caplog):
+    monkeypatch.setattr(slow_query, "SLOW_QUERY_MS", 10_000)
+    with caplog.at_level(logging.WARNING, logger="books.slow_query"):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    assert caplog.text == ""
+
+
+def test_failed_query_does_not_skew_next_log(engine, monkeypatch, caplog):
+    monkeypatch.setattr(slow_query, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="books.slow_query"):
+        with engine.connect() as conn:
+            with pytest.raises(Exception):
+                conn.execute(text("SELECT * FROM missing_table"))
+            conn.execute(text("SELECT 1"))
+    assert len(caplog.records) == 1
+    assert caplog.records[0].getMessage().endswith("statement=SELECT 1")